@@ -1,20 +1,29 @@
 import os
-import json
+import io
+import csv
 import time
 import logging
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import asyncio
 import re
-from collections import Counter
+import types
+import unicodedata
+import functools
+import orjson
+from collections import Counter, defaultdict
 
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, ContextTypes, JobQueue, CallbackQueryHandler, MessageHandler, filters
 
 # --- Configuración y logging ---
 CONFIG_FILE = "config.json"
 STATE_FILE = "processed_ids.json"
+PHOTO_CACHE_FILE = "photo_file_ids.json"
 CATEGORIES_FILE = "categories.json"
 
 # Constantes para rangos de descuento
@@ -26,6 +35,49 @@ DISCOUNT_RANGES = {
     "50+": (50, float('inf'))
 }
 
+# Descarga del Sheet: pedir el CSV comprimido y no esperar indefinidamente
+SHEET_REQUEST_HEADERS = {"Accept-Encoding": "gzip, deflate"}
+SHEET_REQUEST_TIMEOUT = 10
+# Tras un fallo de descarga, segundos durante los que los comandos no vuelven a intentarlo
+SHEET_RETRY_DELAY = 60
+
+# Enlaces de Google Drive ".../file/d/<id>/..." y su equivalente de descarga directa
+_DRIVE_RE = re.compile(r"^.*drive\.google\.com/file/d/([^/]+)/.*$")
+_DRIVE_DIRECT_URL = r"https://drive.google.com/uc?export=view&id=\1"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_WORD_RE = re.compile(r"\w+")
+
+# Campos en los que busca /buscar
+SEARCH_FIELDS = ["nombre", "marca", "descripcion", "categoria", "objetivo"]
+
+# Límites de envío de Telegram: ~30 mensajes/s en total y 1 mensaje/s por chat
+GLOBAL_SEND_RATE = 25
+CHAT_SEND_INTERVAL = 1.05
+# Cada cuántos segundos se descartan los limitadores de chats sin envíos recientes
+CHAT_LIMITER_SWEEP_INTERVAL = 60
+
+# Envíos simultáneos como máximo por cada lista de productos
+SEND_CONCURRENCY = 10
+# Intentos por envío ante esperas de Telegram o fallos de red, y espera base entre ellos
+SEND_MAX_ATTEMPTS = 5
+SEND_RETRY_BACKOFF = 1.0
+# Conexiones HTTP a la API de Telegram (el mismo pool que crea ApplicationBuilder) y
+# tiempos de espera (segundos). Esperar una conexión libre no debe acabar en TimedOut,
+# que call_telegram no reintenta
+TELEGRAM_POOL_SIZE = 256
+TELEGRAM_POOL_TIMEOUT = 20
+TELEGRAM_CONNECT_TIMEOUT = 10
+TELEGRAM_READ_TIMEOUT = 20
+TELEGRAM_WRITE_TIMEOUT = 20
+
+# Álbumes (sendMediaGroup): entre 2 y 10 fotos, con pies de foto de hasta 1024 caracteres
+MEDIA_GROUP_SIZE = 10
+CAPTION_MAX_LENGTH = 1024
+
+# Segundos que se agrupan los cambios (estado, file_id de fotos) antes de escribirlos a disco
+SAVE_DELAY = 5
+
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -34,191 +86,432 @@ logger = logging.getLogger(__name__)
 
 # --- Cargar configuración ---
 def load_config():
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(CONFIG_FILE, "rb") as f:
+        return orjson.loads(f.read())
 
 config = load_config()
 
+# Valores de configuración resueltos una sola vez al arrancar
+CFG = types.SimpleNamespace(
+    bot_token=config.get("TELEGRAM_BOT_TOKEN"),
+    csv_url=config.get("sheet_url") or config.get("SHEET_CSV_URL"),
+    logo_url=config.get("LOGO_URL") or config.get("logo_url"),
+    channel_id=config.get("TELEGRAM_CHANNEL_ID"),
+    update_interval=config.get("UPDATE_INTERVAL_MINUTES", 10),
+    admin_chat_id=config.get("ADMIN_CHAT_ID") or (config.get("admin_users") or [None])[0],
+    admin_ids=frozenset(
+        str(u) for u in [config.get("ADMIN_CHAT_ID"), *config.get("admin_users", [])]
+        if u not in (None, "")
+    ),
+)
+
 # --- Estado local ---
+# En memoria los IDs son un set; en disco se guardan como la lista "IDs"
 def load_state():
+    state = {}
     if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"IDs": [], "last_prices": {}}
+        with open(STATE_FILE, "rb") as f:
+            state = orjson.loads(f.read())
+    return {"ids": set(state.get("IDs", [])), "last_prices": state.get("last_prices", {})}
+
+def _dump_state(state):
+    return orjson.dumps(
+        {"IDs": list(state["ids"]), "last_prices": state["last_prices"]},
+        option=orjson.OPT_NON_STR_KEYS
+    )
+
+# Escritura atómica: un fallo a mitad nunca deja el fichero a medias
+def _write_file(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# --- Escrituras diferidas ---
+# Fichero -> función que devuelve su contenido; se escriben en segundo plano agrupando
+# los cambios de los últimos SAVE_DELAY segundos
+_pending_writes = {}
+_write_task = None
+
+def schedule_write(path, dump):
+    global _write_task
+    _pending_writes[path] = dump
+    if _write_task is None or _write_task.done():
+        _write_task = asyncio.create_task(_write_pending_later())
+
+async def _write_pending_later():
+    while _pending_writes:
+        await asyncio.sleep(SAVE_DELAY)
+        # Cada fichero sale de la cola solo tras escribirse, así el guardado final de
+        # main() cubre lo que quede pendiente si la tarea se cancela a mitad
+        for path, dump in list(_pending_writes.items()):
+            # Se serializa en el hilo del bucle para no leer los datos mientras cambian
+            data = dump()
+            try:
+                await asyncio.to_thread(_write_file, path, data)
+            except Exception as e:
+                logger.error(f"Error guardando {path}: {e}")
+                continue
+            # Si se volvió a programar durante la escritura, se guardará en la siguiente vuelta
+            if _pending_writes.get(path) is dump:
+                del _pending_writes[path]
+
+# Estado en memoria; se persiste en segundo plano con schedule_save_state()
+_state = load_state()
+
+def schedule_save_state():
+    schedule_write(STATE_FILE, lambda: _dump_state(_state))
 
-def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2, ensure_ascii=False)
+# --- Caché de file_id de las fotos enviadas ---
+# URL de la imagen -> file_id de Telegram; reenviar por file_id evita que Telegram
+# vuelva a descargar la imagen
+def load_photo_file_ids():
+    if os.path.exists(PHOTO_CACHE_FILE):
+        with open(PHOTO_CACHE_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    return {}
 
-# --- Cargar/guardar categorías y objetivos ---
+_photo_file_ids = load_photo_file_ids()
+
+def _remember_photo(image_url, message):
+    if image_url in _photo_file_ids or not message.photo:
+        return
+    _photo_file_ids[image_url] = message.photo[-1].file_id
+    schedule_write(PHOTO_CACHE_FILE, lambda: orjson.dumps(_photo_file_ids))
+
+# --- Cargar categorías y objetivos ---
+# categories.json solo recoge las categorías y objetivos vistos; el bot no lo consulta
+# (los teclados salen de los índices del Sheet), así que es un fichero de salida
 def load_categories():
     if os.path.exists(CATEGORIES_FILE):
-        with open(CATEGORIES_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        with open(CATEGORIES_FILE, "rb") as f:
+            return orjson.loads(f.read())
     return {"categorias": [], "objetivos": []}
 
-def save_categories(categories_data):
-    with open(CATEGORIES_FILE, "w", encoding="utf-8") as f:
-        json.dump(categories_data, f, indent=2, ensure_ascii=False)
+# --- Columnas del Sheet ---
+# Nombre de columna canónico: sin tildes, en minúsculas y con "_" en lugar de espacios
+# ("Descripción" -> "descripcion", "Precio descuento" -> "precio_descuento")
+def _canonical_key(name):
+    key = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode()
+    return _WHITESPACE_RE.sub("_", key.strip().lower())
+
+# Producto con claves canónicas (si dos columnas coinciden gana la primera con valor)
+# y el texto en minúsculas en el que busca /buscar
+def _normalize_product(header, row):
+    product = {}
+    for key, value in zip(header, row):
+        if not product.get(key):
+            product[key] = value.strip()
+
+    imagen = product.get("imagen")
+    if imagen:
+        product["imagen"] = _DRIVE_RE.sub(_DRIVE_DIRECT_URL, imagen)
+
+    product["_search"] = " ".join(product.get(name, "") for name in SEARCH_FIELDS).lower()
+    return product
+
+# Rango de DISCOUNT_RANGES al que pertenece un descuento ("15%" -> "10-20"), o None
+def _discount_range(descuento):
+    try:
+        descuento = float(descuento.replace('%', ''))
+    except ValueError:
+        return None
+    for rango, (min_discount, max_discount) in DISCOUNT_RANGES.items():
+        if min_discount <= descuento < max_discount:
+            return rango
+    return None
+
+# Productos normalizados e índices (posiciones en "products") por categoría,
+# objetivo, rango de descuento y palabra del texto de búsqueda, construidos una vez por descarga
+def normalize_products(header, rows):
+    products = []
+    by_categoria = defaultdict(list)
+    by_objetivo = defaultdict(list)
+    by_descuento = defaultdict(list)
+    by_token = defaultdict(set)
+
+    for row in rows:
+        if not any(row):
+            continue
+        product = _normalize_product(header, row)
+        i = len(products)
+        products.append(product)
+
+        if product.get("categoria"):
+            by_categoria[product["categoria"]].append(i)
+        if product.get("objetivo"):
+            by_objetivo[product["objetivo"]].append(i)
+        rango = _discount_range(product.get("descuento", ""))
+        if rango:
+            by_descuento[rango].append(i)
+        for token in _WORD_RE.findall(product["_search"]):
+            by_token[token].add(i)
+
+    return {
+        "products": products,
+        "by_categoria": dict(by_categoria),
+        "by_objetivo": dict(by_objetivo),
+        "by_descuento": dict(by_descuento),
+        "by_token": dict(by_token),
+    }
+
+# Posiciones de los productos cuyo texto de búsqueda contiene `term`. Una palabra
+# solo puede aparecer dentro de una palabra del producto, así que basta con recorrer
+# el vocabulario del índice; los términos con otros caracteres recorren los productos
+def search_products(sheet, term):
+    if _WORD_RE.fullmatch(term):
+        hits = set()
+        for token, positions in sheet["by_token"].items():
+            if term in token:
+                hits |= positions
+        return hits
+    return {i for i, product in enumerate(sheet["products"]) if term in product["_search"]}
 
 # --- Actualizar categorías y objetivos ---
-def update_categories_and_objectives(sheet_data):
-    # Cargar datos existentes
-    categories_data = load_categories()
-    
-    # Extraer categorías y objetivos únicos
-    categorias = set(categories_data.get("categorias", []))
-    objetivos = set(categories_data.get("objetivos", []))
-    
-    # Añadir nuevas categorías y objetivos
-    for product in sheet_data:
-        # Manejar categoría
-        cat = product.get("Categoria") or product.get("categoria")
-        if cat is not None and not pd.isna(cat):  # Verificar que no sea None ni NaN
-            if isinstance(cat, (float, int)):
-                try:
-                    cat = str(int(cat)) if not pd.isna(cat) else None
-                except ValueError:
-                    cat = str(cat)
-            elif isinstance(cat, str):
-                cat = cat.strip() if cat.strip() else None
-            else:
-                cat = None
-            
-            if cat:
-                categorias.add(cat)
-        
-        # Manejar objetivo
-        obj = product.get("Objetivo") or product.get("objetivo")
-        if obj is not None and not pd.isna(obj):  # Verificar que no sea None ni NaN
-            if isinstance(obj, (float, int)):
-                try:
-                    obj = str(int(obj)) if not pd.isna(obj) else None
-                except ValueError:
-                    obj = str(obj)
-            elif isinstance(obj, str):
-                obj = obj.strip() if obj.strip() else None
-            else:
-                obj = None
-            
-            if obj:
-                objetivos.add(obj)
+# Se mantienen en memoria y solo se escriben a disco (en segundo plano) si cambian
+_categories = load_categories()
+
+def update_categories_and_objectives(sheet):
+    global _categories
+    
+    # Añadir nuevas categorías y objetivos únicos
+    categorias = set(_categories.get("categorias", []))
+    categorias.update(sheet["by_categoria"])
+
+    objetivos = set(_categories.get("objetivos", []))
+    objetivos.update(sheet["by_objetivo"])
     
     # Guardar datos actualizados
     categories_data = {
-        "categorias": sorted(list(categorias)),
-        "objetivos": sorted(list(objetivos))
+        "categorias": sorted(categorias),
+        "objetivos": sorted(objetivos)
     }
-    save_categories(categories_data)
+    if categories_data != _categories:
+        _categories = categories_data
+        schedule_write(CATEGORIES_FILE, lambda: orjson.dumps(_categories, option=orjson.OPT_INDENT_2))
     
     return categories_data
 
 # --- Leer Google Sheet como CSV ---
-def fetch_sheet_data(csv_url):
-    try:
-        df = pd.read_csv(csv_url)
-        data = df.to_dict("records")
-        logger.info(f"Leídos {len(data)} productos del Sheet.")
-        return data
-    except Exception as e:
-        logger.error(f"Error leyendo el Sheet: {e}")
-        return None
+# Sesión compartida: reutiliza la conexión TLS con Google entre descargas
+_SHEET_SESSION = requests.Session()
+_SHEET_SESSION.headers.update(SHEET_REQUEST_HEADERS)
+_SHEET_SESSION.mount("https://", HTTPAdapter(pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.3)))
+
+# Devuelve (datos, etag); datos es None si el Sheet no ha cambiado (HTTP 304)
+def fetch_sheet_data(csv_url, etag=None):
+    headers = {"If-None-Match": etag} if etag else None
+    with _SHEET_SESSION.get(csv_url, headers=headers, timeout=SHEET_REQUEST_TIMEOUT, stream=True) as response:
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+
+        # Se descomprime y parsea según llega, sin cargar el CSV entero en memoria
+        response.raw.decode_content = True
+        rows = csv.reader(io.TextIOWrapper(response.raw, encoding="utf-8-sig", newline=""))
+        header = [_canonical_key(name) for name in next(rows, [])]
+        sheet = normalize_products(header, rows)
+
+    logger.info(f"Leídos {len(sheet['products'])} productos del Sheet.")
+    return sheet, response.headers.get("ETag")
+
+# --- Caché compartida de los datos del Sheet ---
+_SHEET_CACHE = {"ts": 0.0, "data": None, "etag": None, "retry_at": 0.0}
+_SHEET_LOCK = asyncio.Lock()
+
+# Los datos se reutilizan durante un intervalo de actualización; el job de monitoreo
+# los refresca con force=True, así los comandos casi nunca esperan a una descarga.
+# Si la descarga falla los comandos siguen recibiendo los últimos datos leídos; con
+# force=True se devuelve None para que el job avise al admin
+async def get_sheet_data(csv_url, ttl=CFG.update_interval * 60, force=False):
+    async with _SHEET_LOCK:
+        now = time.monotonic()
+        fresh = now - _SHEET_CACHE["ts"] < ttl
+        if _SHEET_CACHE["data"] is not None and fresh and not force:
+            return _SHEET_CACHE["data"]
+        if now < _SHEET_CACHE["retry_at"] and not force:
+            return _SHEET_CACHE["data"]
+
+        etag = _SHEET_CACHE["etag"] if _SHEET_CACHE["data"] is not None else None
+        try:
+            sheet, etag = await asyncio.to_thread(fetch_sheet_data, csv_url, etag)
+        except Exception as e:
+            logger.error(f"Error leyendo el Sheet: {e}")
+            _SHEET_CACHE["retry_at"] = time.monotonic() + SHEET_RETRY_DELAY
+            return None if force else _SHEET_CACHE["data"]
+
+        if sheet is not None:
+            _SHEET_CACHE["data"] = sheet
+            _format_product_message.cache_clear()
+        _SHEET_CACHE["etag"] = etag
+        _SHEET_CACHE["ts"] = time.monotonic()
+        return _SHEET_CACHE["data"]
 
 # --- Formato del mensaje HTML ---
-def format_product_message(product, change_type=None, logo_url=None):
-    html = []
-
-    # Logo
-    if logo_url and logo_url.strip():
-        html.append(f'<a href="{logo_url}">&#8205;</a>')
-
-    # Encabezado de cambio
-    if change_type == "new":
-        html.append('🆕 <b>Nuevo Producto:</b>')
-    elif change_type == "discount":
-        html.append('🔥 <b>¡Nuevo descuento!</b>')
-    elif change_type == "search":
-        html.append('🔍 <b>Resultado de búsqueda:</b>')
-
-    html.append("")
-
-    # Nombre y Marca
-    nombre = product.get("Nombre") or product.get("nombre")
-    if nombre:
-        html.append(f'🔹 <b>Nombre:</b> {nombre}')
-    marca = product.get("Marca") or product.get("marca")
-    if marca:
-        html.append(f'🔸 <b>Marca:</b> {marca}')
-
-    html.append("")
-
-    # Precios y descuento
-    precio = product.get("Precio") or product.get("precio")
-    descuento = product.get("Descuento") or product.get("descuento")
-    precio_desc = product.get("Precio_descuento") or product.get("precio_descuento")
-    if precio:
-        html.append(f'💲 <b>Precio original:</b> <s>{precio}€</s>')
-    if descuento:
-        html.append(f'🎯 <b>Descuento:</b> {descuento}%')
-    if precio_desc:
-        html.append(f'✅ <b>Precio con descuento:</b> <b>{precio_desc}€</b>')
-
-    html.append("")
-
-    # Descripción
-    descripcion = product.get("Descripcion") or product.get("Descripción") or product.get("descripcion")
-    if descripcion:
-        html.append(f'📝 <b>Descripción:</b>\n{descripcion}')
-
-    html.append("")
-
-    # Categoria y Objetivo
-    categoria = product.get("Categoria") or product.get("categoria")
-    if categoria is not None and not pd.isna(categoria):
-        if isinstance(categoria, (float, int)):
-            try:
-                categoria = str(int(categoria)) if not pd.isna(categoria) else None
-            except ValueError:
-                categoria = str(categoria)
-        html.append(f'📦 <b>Categoria:</b> {categoria}')
-    
-    objetivo = product.get("Objetivo") or product.get("objetivo")
-    if objetivo is not None and not pd.isna(objetivo):
-        if isinstance(objetivo, (float, int)):
+# Mensajes de una lista de productos; la cabecera común se construye una sola vez
+def format_products(products, change_type=None, logo_url=None):
+    head = _message_head(change_type, logo_url)
+    return [_format_product_message(tuple(product.items()), head) for product in products]
+
+CHANGE_HEADERS = {
+    "new": '🆕 <b>Nuevo Producto:</b>',
+    "discount": '🔥 <b>¡Nuevo descuento!</b>',
+    "search": '🔍 <b>Resultado de búsqueda:</b>',
+}
+
+# Logo (enlace invisible para la vista previa) y título del tipo de cambio, o None
+def _message_head(change_type, logo_url):
+    lineas = (
+        f'<a href="{logo_url}">&#8205;</a>' if logo_url and logo_url.strip() else None,
+        CHANGE_HEADERS.get(change_type),
+    )
+    return "\n".join(filter(None, lineas)) or None
+
+@functools.lru_cache(maxsize=4096)
+def _format_product_message(items, head):
+    p = dict(items)
+    nombre, marca = p.get("nombre"), p.get("marca")
+    precio, descuento, precio_desc = p.get("precio"), p.get("descuento"), p.get("precio_descuento")
+    descripcion, categoria, objetivo = p.get("descripcion"), p.get("categoria"), p.get("objetivo")
+
+    # Secciones separadas por una línea en blanco; las líneas vacías (None) se omiten
+    secciones = (
+        (head,),
+        (
+            f'🔹 <b>Nombre:</b> {nombre}' if nombre else None,
+            f'🔸 <b>Marca:</b> {marca}' if marca else None,
+        ),
+        (
+            f'💲 <b>Precio original:</b> <s>{precio}€</s>' if precio else None,
+            f'🎯 <b>Descuento:</b> {descuento}%' if descuento else None,
+            f'✅ <b>Precio con descuento:</b> <b>{precio_desc}€</b>' if precio_desc else None,
+        ),
+        (
+            f'📝 <b>Descripción:</b>\n{descripcion}' if descripcion else None,
+        ),
+        (
+            f'📦 <b>Categoria:</b> {categoria}' if categoria else None,
+            f'🎯 <b>Objetivo:</b> {objetivo}' if objetivo else None,
+        ),
+    )
+    bloques = ("\n".join(filter(None, seccion)) for seccion in secciones)
+    return "\n\n".join(filter(None, bloques))
+
+# --- Limitador de envíos (token bucket) ---
+class TokenBucket:
+    def __init__(self, rate, per=1.0):
+        self.rate = rate
+        self.per = per
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    # Detiene el bucket durante delay segundos; quien llame a acquire() esperará
+    def pause(self, delay):
+        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._tokens = 0
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+    # Lleno, sin pausa y sin nadie esperando: descartarlo no pierde nada
+    def idle(self, now):
+        return not self._lock.locked() and now >= self._paused_until and now - self._updated >= self.per
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+_global_limiter = TokenBucket(GLOBAL_SEND_RATE, 1.0)
+_chat_limiters = {}
+_chat_limiters_swept = time.monotonic()
+
+# Limitador del chat; de vez en cuando se eliminan los inactivos para que el
+# diccionario no crezca con cada chat que haya usado el bot
+def _chat_limiter(chat_id):
+    global _chat_limiters_swept
+    now = time.monotonic()
+    if now - _chat_limiters_swept >= CHAT_LIMITER_SWEEP_INTERVAL:
+        for key in [key for key, limiter in _chat_limiters.items() if limiter.idle(now)]:
+            del _chat_limiters[key]
+        _chat_limiters_swept = now
+
+    key = str(chat_id)
+    limiter = _chat_limiters.get(key)
+    if limiter is None:
+        limiter = _chat_limiters[key] = TokenBucket(1, CHAT_SEND_INTERVAL)
+    return limiter
+
+# Llama a la API respetando los límites y reintentando si Telegram pide esperar
+# Un RetryAfter pausa el bucket global para que el resto de envíos también esperen.
+# TimedOut no se reintenta: el mensaje puede haber llegado y se duplicaría.
+# BadRequest (URL o file_id inválido, HTML mal formado...) tampoco: fallaría igual
+async def call_telegram(method, chat_id, **kwargs):
+    for attempt in range(1, SEND_MAX_ATTEMPTS + 1):
+        async with _chat_limiter(chat_id), _global_limiter:
             try:
-                objetivo = str(int(objetivo)) if not pd.isna(objetivo) else None
-            except ValueError:
-                objetivo = str(objetivo)
-        html.append(f'🎯 <b>Objetivo:</b> {objetivo}')
+                return await method(chat_id=chat_id, **kwargs)
+            except RetryAfter as e:
+                if attempt == SEND_MAX_ATTEMPTS:
+                    raise
+                logger.warning(f"Límite de Telegram alcanzado, reintentando en {e.retry_after}s")
+                _global_limiter.pause(e.retry_after)
+                continue
+            except (TimedOut, BadRequest):
+                raise
+            except NetworkError as e:
+                if attempt == SEND_MAX_ATTEMPTS:
+                    raise
+                delay = SEND_RETRY_BACKOFF * 2 ** (attempt - 1)
+                logger.warning(f"Error de red enviando a {chat_id}, reintentando en {delay}s: {e}")
+        await asyncio.sleep(delay)
 
-    return "\n".join([line for line in html]).strip()
+def _is_photo_url(image_url):
+    return isinstance(image_url, str) and image_url.startswith(('http://', 'https://'))
 
 # --- Enviar mensaje ---
 async def send_message(bot: Bot, chat_id: str, text: str, image_url: str = None):
     try:
-        if image_url and isinstance(image_url, str) and "drive.google.com/file/d/" in image_url:
-            file_id = re.search(r"/d/([^/]+)/", image_url)
-            if file_id:
-                image_url = f"https://drive.google.com/uc?export=view&id={file_id.group(1)}"
-        
-        if image_url and isinstance(image_url, str) and image_url.strip() and image_url.startswith(('http://', 'https://')):
+        if _is_photo_url(image_url):
             try:
-                await bot.send_photo(
-                    chat_id=chat_id,
-                    photo=image_url,
+                message = await call_telegram(
+                    bot.send_photo,
+                    chat_id,
+                    photo=_photo_file_ids.get(image_url, image_url),
                     caption=text,
                     parse_mode=ParseMode.HTML
                 )
+                _remember_photo(image_url, message)
             except Exception as e:
                 logger.error(f"Error enviando con imagen, usando solo texto: {e}")
-                await bot.send_message(
-                    chat_id=chat_id,
+                # Un file_id caducado no debe volver a usarse
+                _photo_file_ids.pop(image_url, None)
+                await call_telegram(
+                    bot.send_message,
+                    chat_id,
                     text=text,
                     parse_mode=ParseMode.HTML
                 )
         else:
-            await bot.send_message(
-                chat_id=chat_id,
+            await call_telegram(
+                bot.send_message,
+                chat_id,
                 text=text,
                 parse_mode=ParseMode.HTML
             )
@@ -228,44 +521,93 @@ async def send_message(bot: Bot, chat_id: str, text: str, image_url: str = None)
             return
         await send_admin_error(bot, f"Error enviando mensaje: {e}")
 
+# --- Enviar varias fotos en un único álbum ---
+# items es una lista de (texto, image_url). Si Telegram rechaza el álbum (BadRequest) se
+# envían una a una; con otros errores no, porque el álbum puede haber llegado y se duplicaría
+async def send_media_group(bot: Bot, chat_id, items):
+    media = [
+        InputMediaPhoto(media=_photo_file_ids.get(image_url, image_url), caption=text, parse_mode=ParseMode.HTML)
+        for text, image_url in items
+    ]
+    try:
+        messages = await call_telegram(bot.send_media_group, chat_id, media=media)
+        for (_, image_url), message in zip(items, messages):
+            _remember_photo(image_url, message)
+    except BadRequest as e:
+        logger.error(f"Error enviando álbum, enviando las fotos una a una: {e}")
+        await asyncio.gather(*(send_message(bot, chat_id, text, image_url) for text, image_url in items))
+    except Exception as e:
+        logger.error(f"Error enviando álbum: {e}")
+        if is_admin_id(chat_id):
+            return
+        await send_admin_error(bot, f"Error enviando álbum: {e}")
+
+# --- Enviar una lista de productos ---
+# Los productos consecutivos con foto y pie corto se agrupan en álbumes; el resto va
+# uno a uno. Los envíos se encolan en el orden del Sheet
+async def send_products(bot: Bot, chat_id, products, change_type=None, logo_url=None):
+    envios = []
+    album = []
+
+    def cerrar_album():
+        if len(album) == 1:
+            envios.append(send_message(bot, chat_id, *album[0]))
+        elif album:
+            envios.append(send_media_group(bot, chat_id, list(album)))
+        album.clear()
+
+    textos = format_products(products, change_type=change_type, logo_url=logo_url)
+    for product, text in zip(products, textos):
+        image_url = product.get("imagen")
+        if _is_photo_url(image_url) and len(text) <= CAPTION_MAX_LENGTH:
+            album.append((text, image_url))
+            if len(album) == MEDIA_GROUP_SIZE:
+                cerrar_album()
+        else:
+            cerrar_album()
+            envios.append(send_message(bot, chat_id, text, image_url))
+    cerrar_album()
+
+    # El semáforo es por lista: una lista larga no bloquea los envíos a otros chats
+    semaforo = asyncio.Semaphore(SEND_CONCURRENCY)
+
+    async def enviar(envio):
+        async with semaforo:
+            await envio
+
+    await asyncio.gather(*(enviar(envio) for envio in envios))
+
 # --- Notificar errores al admin ---
 async def send_admin_error(bot: Bot, message: str):
-    admin_id = config.get("ADMIN_CHAT_ID") or config.get("admin_users", [None])[0]
-    if admin_id:
+    if CFG.admin_chat_id:
         try:
-            await bot.send_message(chat_id=admin_id, text=f"⚠️ Bot error:\n{message}")
+            await bot.send_message(chat_id=CFG.admin_chat_id, text=f"⚠️ Bot error:\n{message}")
         except Exception as e:
             logger.error(f"No se pudo notificar al admin: {e}")
 
 # --- Verificar si un usuario es admin ---
 def is_admin_id(user_id):
-    admin_id = config.get("ADMIN_CHAT_ID")
-    admin_users = config.get("admin_users", [])
-    
-    if admin_id and str(admin_id) == str(user_id):
-        return True
-    
-    return user_id in admin_users or str(user_id) in [str(u) for u in admin_users]
+    return str(user_id) in CFG.admin_ids
 
 # --- Comando /ofertas ---
-async def ofertas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [
-            InlineKeyboardButton("0-10%", callback_data="discount_0-10"),
-            InlineKeyboardButton("10-20%", callback_data="discount_10-20")
-        ],
-        [
-            InlineKeyboardButton("20-30%", callback_data="discount_20-30"),
-            InlineKeyboardButton("30-50%", callback_data="discount_30-50")
-        ],
-        [
-            InlineKeyboardButton("Más del 50%", callback_data="discount_50+")
-        ]
+OFERTAS_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("0-10%", callback_data="discount_0-10"),
+        InlineKeyboardButton("10-20%", callback_data="discount_10-20")
+    ],
+    [
+        InlineKeyboardButton("20-30%", callback_data="discount_20-30"),
+        InlineKeyboardButton("30-50%", callback_data="discount_30-50")
+    ],
+    [
+        InlineKeyboardButton("Más del 50%", callback_data="discount_50+")
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+])
+
+async def ofertas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Selecciona el rango de descuento que quieres ver:",
-        reply_markup=reply_markup
+        reply_markup=OFERTAS_MARKUP
     )
 
 # --- Manejador de selección de descuento ---
@@ -276,25 +618,18 @@ async def handle_discount_selection(update: Update, context: ContextTypes.DEFAUL
     selected_range = query.data.split('_')[1]
     min_discount, max_discount = DISCOUNT_RANGES[selected_range]
 
-    csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
+    csv_url = CFG.csv_url
     if not csv_url:
         await query.edit_message_text("Error: URL de la hoja de cálculo no configurada.")
         return
         
-    sheet_data = fetch_sheet_data(csv_url)
-    if sheet_data is None:
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
         await query.edit_message_text("No se pudo acceder a los datos. Intenta más tarde.")
         return
 
-    filtered_products = []
-    for product in sheet_data:
-        descuento = product.get("Descuento") or product.get("descuento")
-        try:
-            descuento = float(str(descuento).replace('%', ''))
-            if min_discount <= descuento < max_discount or (selected_range == "50+" and descuento >= 50):
-                filtered_products.append(product)
-        except (ValueError, TypeError):
-            continue
+    products = sheet["products"]
+    filtered_products = [products[i] for i in sheet["by_descuento"].get(selected_range, ())]
 
     if not filtered_products:
         await query.edit_message_text(
@@ -308,25 +643,14 @@ async def handle_discount_selection(update: Update, context: ContextTypes.DEFAUL
     )
     
     chat_id = update.effective_chat.id
-    logo_url = config.get("LOGO_URL") or config.get("logo_url")
+    logo_url = CFG.logo_url
     
-    for i, product in enumerate(filtered_products):
-        text = format_product_message(product, logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        
-        await send_message(
-            context.bot,
-            chat_id,
-            text,
-            image_url
-        )
-        
-        if i < len(filtered_products) - 1:
-            await asyncio.sleep(1)
+    await send_products(context.bot, chat_id, filtered_products, logo_url=logo_url)
     
     if filtered_products:
-        await context.bot.send_message(
-            chat_id=chat_id,
+        await call_telegram(
+            context.bot.send_message,
+            chat_id,
             text=f"✅ Se han enviado todos los {len(filtered_products)} productos con descuentos entre {min_discount}% y {max_discount}%."
         )
 
@@ -341,31 +665,23 @@ async def buscar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     search_term = " ".join(context.args).lower()
     
-    csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
+    csv_url = CFG.csv_url
     if not csv_url:
         await update.message.reply_text("Error: URL de la hoja de cálculo no configurada.")
         return
         
-    sheet_data = fetch_sheet_data(csv_url)
-    if sheet_data is None:
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
         await update.message.reply_text("No se pudo acceder a los datos. Intenta más tarde.")
         return
     
-    found_products = []
-    
-    for product in sheet_data:
-        product_text = ""
-        
-        for field in ["Nombre", "nombre", "Marca", "marca", "Descripcion", "Descripción", "descripcion", 
-                      "Categoria", "categoria", "Objetivo", "objetivo"]:
-            if product.get(field):
-                field_value = product.get(field)
-                if isinstance(field_value, (float, int)):
-                    field_value = str(int(field_value))
-                product_text += str(field_value).lower() + " "
-        
-        if search_term in product_text:
-            found_products.append(product)
+    # Cada palabra del término debe aparecer en el producto, en cualquier orden
+    hits = None
+    for term in search_term.split():
+        positions = search_products(sheet, term)
+        hits = positions if hits is None else hits & positions
+    products = sheet["products"]
+    found_products = [products[i] for i in sorted(hits or ())]
     
     if not found_products:
         await update.message.reply_text(
@@ -379,45 +695,29 @@ async def buscar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
     chat_id = update.effective_chat.id
-    logo_url = config.get("LOGO_URL") or config.get("logo_url")
+    logo_url = CFG.logo_url
     
-    for i, product in enumerate(found_products):
-        text = format_product_message(product, change_type="search", logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        
-        await send_message(
-            context.bot,
-            chat_id,
-            text,
-            image_url
-        )
-        
-        if i < len(found_products) - 1:
-            await asyncio.sleep(1)
+    await send_products(context.bot, chat_id, found_products, change_type="search", logo_url=logo_url)
     
-    await context.bot.send_message(
-        chat_id=chat_id,
+    await call_telegram(
+        context.bot.send_message,
+        chat_id,
         text=f"✅ Se han enviado todos los {len(found_products)} productos que coinciden con '{search_term}'."
     )
 
 # --- Comando para mostrar categorías ---
 async def categoria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    categories_data = load_categories()
-    categorias = categories_data.get("categorias", [])
-    
-    if not categorias:
-        csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
-        if not csv_url:
-            await update.message.reply_text("Error: URL de la hoja de cálculo no configurada.")
-            return
-            
-        sheet_data = fetch_sheet_data(csv_url)
-        if sheet_data is None:
-            await update.message.reply_text("No se pudo acceder a los datos. Intenta más tarde.")
-            return
+    csv_url = CFG.csv_url
+    if not csv_url:
+        await update.message.reply_text("Error: URL de la hoja de cálculo no configurada.")
+        return
         
-        categories_data = update_categories_and_objectives(sheet_data)
-        categorias = categories_data.get("categorias", [])
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
+        await update.message.reply_text("No se pudo acceder a los datos. Intenta más tarde.")
+        return
+    
+    categorias = sorted(sheet["by_categoria"])
     
     if not categorias:
         await update.message.reply_text("No se encontraron categorías.")
@@ -449,32 +749,18 @@ async def handle_categoria_selection(update: Update, context: ContextTypes.DEFAU
     
     selected_categoria = query.data.split('_', 1)[1]
     
-    csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
+    csv_url = CFG.csv_url
     if not csv_url:
         await query.edit_message_text("Error: URL de la hoja de cálculo no configurada.")
         return
         
-    sheet_data = fetch_sheet_data(csv_url)
-    if sheet_data is None:
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
         await query.edit_message_text("No se pudo acceder a los datos. Intenta más tarde.")
         return
     
-    filtered_products = []
-    for product in sheet_data:
-        categoria = product.get("Categoria") or product.get("categoria")
-        if categoria is not None and not pd.isna(categoria):
-            if isinstance(categoria, (float, int)):
-                try:
-                    categoria = str(int(categoria)) if not pd.isna(categoria) else None
-                except ValueError:
-                    categoria = str(categoria)
-            elif isinstance(categoria, str):
-                categoria = categoria.strip() if categoria.strip() else None
-            else:
-                categoria = None
-            
-            if categoria == selected_categoria:
-                filtered_products.append(product)
+    products = sheet["products"]
+    filtered_products = [products[i] for i in sheet["by_categoria"].get(selected_categoria, ())]
     
     if not filtered_products:
         await query.edit_message_text(
@@ -488,46 +774,30 @@ async def handle_categoria_selection(update: Update, context: ContextTypes.DEFAU
     )
     
     chat_id = update.effective_chat.id
-    logo_url = config.get("LOGO_URL") or config.get("logo_url")
+    logo_url = CFG.logo_url
     
-    for i, product in enumerate(filtered_products):
-        text = format_product_message(product, logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        
-        await send_message(
-            context.bot,
-            chat_id,
-            text,
-            image_url
-        )
-        
-        if i < len(filtered_products) - 1:
-            await asyncio.sleep(1)
+    await send_products(context.bot, chat_id, filtered_products, logo_url=logo_url)
     
     if filtered_products:
-        await context.bot.send_message(
-            chat_id=chat_id,
+        await call_telegram(
+            context.bot.send_message,
+            chat_id,
             text=f"✅ Se han enviado todos los {len(filtered_products)} productos de la categoría '{selected_categoria}' Si quieres estar al día unete al canal @Supleshop_Ofertas."
         )
 
 # --- Comando para mostrar objetivos ---
 async def objetivo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    categories_data = load_categories()
-    objetivos = categories_data.get("objetivos", [])
-    
-    if not objetivos:
-        csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
-        if not csv_url:
-            await update.message.reply_text("Error: URL de la hoja de cálculo no configurada.")
-            return
-            
-        sheet_data = fetch_sheet_data(csv_url)
-        if sheet_data is None:
-            await update.message.reply_text("No se pudo acceder a los datos. Intenta más tarde.")
-            return
+    csv_url = CFG.csv_url
+    if not csv_url:
+        await update.message.reply_text("Error: URL de la hoja de cálculo no configurada.")
+        return
         
-        categories_data = update_categories_and_objectives(sheet_data)
-        objetivos = categories_data.get("objetivos", [])
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
+        await update.message.reply_text("No se pudo acceder a los datos. Intenta más tarde.")
+        return
+    
+    objetivos = sorted(sheet["by_objetivo"])
     
     if not objetivos:
         await update.message.reply_text("No se encontraron objetivos.")
@@ -559,32 +829,18 @@ async def handle_objetivo_selection(update: Update, context: ContextTypes.DEFAUL
     
     selected_objetivo = query.data.split('_', 1)[1]
     
-    csv_url = config.get("sheet_url") or config.get("SHEET_CSV_URL")
+    csv_url = CFG.csv_url
     if not csv_url:
         await query.edit_message_text("Error: URL de la hoja de cálculo no configurada.")
         return
         
-    sheet_data = fetch_sheet_data(csv_url)
-    if sheet_data is None:
+    sheet = await get_sheet_data(csv_url)
+    if sheet is None:
         await query.edit_message_text("No se pudo acceder a los datos. Intenta más tarde.")
         return
     
-    filtered_products = []
-    for product in sheet_data:
-        objetivo = product.get("Objetivo") or product.get("objetivo")
-        if objetivo is not None and not pd.isna(objetivo):  # Verificar que no sea NaN
-            if isinstance(objetivo, (float, int)):
-                try:
-                    objetivo = str(int(objetivo)) if not pd.isna(objetivo) else None
-                except ValueError:
-                    objetivo = str(objetivo)
-            elif isinstance(objetivo, str):
-                objetivo = objetivo.strip() if objetivo.strip() else None
-            else:
-                objetivo = None
-            
-            if objetivo == selected_objetivo:
-                filtered_products.append(product)
+    products = sheet["products"]
+    filtered_products = [products[i] for i in sheet["by_objetivo"].get(selected_objetivo, ())]
     
     if not filtered_products:
         await query.edit_message_text(
@@ -598,77 +854,71 @@ async def handle_objetivo_selection(update: Update, context: ContextTypes.DEFAUL
     )
     
     chat_id = update.effective_chat.id
-    logo_url = config.get("LOGO_URL") or config.get("logo_url")
+    logo_url = CFG.logo_url
     
-    for i, product in enumerate(filtered_products):
-        text = format_product_message(product, logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        
-        await send_message(
-            context.bot,
-            chat_id,
-            text,
-            image_url
-        )
-        
-        if i < len(filtered_products) - 1:
-            await asyncio.sleep(1)
+    await send_products(context.bot, chat_id, filtered_products, logo_url=logo_url)
     
     if filtered_products:
-        await context.bot.send_message(
-            chat_id=chat_id,
+        await call_telegram(
+            context.bot.send_message,
+            chat_id,
             text=f"✅ Se han enviado todos los {len(filtered_products)} productos con el objetivo '{selected_objetivo}'."
         )
 
+# --- Enrutado de los botones según el prefijo de callback_data ---
+CALLBACK_ROUTES = {
+    "discount": handle_discount_selection,
+    "cat": handle_categoria_selection,
+    "obj": handle_objetivo_selection,
+}
+
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # data es None en algunos callbacks (p. ej. juegos); se tratan como desconocidos
+    data = update.callback_query.data or ""
+    prefix = data.partition('_')[0]
+    handler = CALLBACK_ROUTES.get(prefix)
+    if handler is None:
+        await update.callback_query.answer()
+        return
+    await handler(update, context)
+
 # --- Lógica principal de monitoreo ---
 async def process_sheet_data(context: ContextTypes.DEFAULT_TYPE):
     bot = context.bot
     
-    csv_url = config.get("SHEET_CSV_URL") or config.get("sheet_url")
+    csv_url = CFG.csv_url
     if not csv_url:
         await send_admin_error(bot, "Error: URL de la hoja de cálculo no configurada.")
         return
         
-    sheet_data = fetch_sheet_data(csv_url)
-    if sheet_data is None:
+    sheet = await get_sheet_data(csv_url, force=True)
+    if sheet is None:
         await send_admin_error(bot, "No se pudo acceder al Google Sheet. Reintentando en 1 minuto.")
         return
 
-    update_categories_and_objectives(sheet_data)
-
-    state = load_state()
-    ids = set(state["IDs"])
-    last_prices = state.get("last_prices", {})
+    update_categories_and_objectives(sheet)
 
-    logo_url = config.get("LOGO_URL") or config.get("logo_url")
-    channel_id = config.get("TELEGRAM_CHANNEL_ID")
-    
-    if not channel_id:
-        for product in sheet_data:
-            pid = str(product.get("ID") or product.get("id") or "").strip()
-            if not pid:
-                continue
-                
-            precio_desc = str(product.get("Precio_descuento") or product.get("precio_descuento") or "").strip()
-            
-            if pid not in ids:
-                ids.add(pid)
-                last_prices[pid] = precio_desc
-            elif precio_desc and last_prices.get(pid) != precio_desc:
-                last_prices[pid] = precio_desc
-                
-        save_state({"IDs": list(ids), "last_prices": last_prices})
+    # Huella de los pares (id, precio con descuento): si no ha cambiado desde la última
+    # revisión no hay productos nuevos ni descuentos y no hace falta comparar fila a fila.
+    # Solo vive en memoria (hash() cambia entre procesos)
+    digest = hash(frozenset(
+        (product.get("id"), product.get("precio_descuento", "")) for product in sheet["products"]
+    ))
+    if digest == _state.get("digest"):
         return
-        
+    _state["digest"] = digest
+
+    ids = _state["ids"]
+    last_prices = _state["last_prices"]
     nuevos = []
     descuentos = []
 
-    for product in sheet_data:
-        pid = str(product.get("ID") or product.get("id") or "").strip()
+    for product in sheet["products"]:
+        pid = product.get("id")
         if not pid:
             continue
 
-        precio_desc = str(product.get("Precio_descuento") or product.get("precio_descuento") or "").strip()
+        precio_desc = product.get("precio_descuento", "")
 
         if pid not in ids:
             nuevos.append(product)
@@ -678,19 +928,17 @@ async def process_sheet_data(context: ContextTypes.DEFAULT_TYPE):
             descuentos.append(product)
             last_prices[pid] = precio_desc
 
-    for product in nuevos:
-        text = format_product_message(product, change_type="new", logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        await send_message(bot, channel_id, text, image_url)
-        await asyncio.sleep(1)
+    if nuevos or descuentos:
+        schedule_save_state()
 
-    for product in descuentos:
-        text = format_product_message(product, change_type="discount", logo_url=logo_url)
-        image_url = product.get("imagen") or product.get("Imagen")
-        await send_message(bot, channel_id, text, image_url)
-        await asyncio.sleep(1)
+    # Sin canal configurado solo se registra el estado, sin publicar nada
+    channel_id = CFG.channel_id
+    if not channel_id:
+        return
 
-    save_state({"IDs": list(ids), "last_prices": last_prices})
+    logo_url = CFG.logo_url
+    await send_products(bot, channel_id, nuevos, change_type="new", logo_url=logo_url)
+    await send_products(bot, channel_id, descuentos, change_type="discount", logo_url=logo_url)
 
 # --- Comando /force_update ---
 async def force_update(update, context):
@@ -703,38 +951,40 @@ async def force_update(update, context):
     await update.message.reply_text("Actualización completada.")
 
 # --- Comando /start ---
+START_TEXT = (
+    "¡Bienvenido al Bot de Búsqueda de Productos de Supleshop! 🎉\n\n"
+    "Este bot te permite buscar productos y sus descuentos.\n\n"
+    "Comandos disponibles:\n"
+    "/ofertas - Ver productos por rango de descuento\n"
+    "/buscar [término] - Buscar productos por palabra clave\n"
+    "/categoria - Ver productos por categoría\n"
+    "/objetivo - Ver productos por objetivo\n"
+)
+
 async def start_command(update, context):
-    await update.message.reply_text(
-        "¡Bienvenido al Bot de Búsqueda de Productos de Supleshop! 🎉\n\n"
-        "Este bot te permite buscar productos y sus descuentos.\n\n"
-        "Comandos disponibles:\n"
-        "/ofertas - Ver productos por rango de descuento\n"
-        "/buscar [término] - Buscar productos por palabra clave\n"
-        "/categoria - Ver productos por categoría\n"
-        "/objetivo - Ver productos por objetivo\n"
-    )
+    await update.message.reply_text(START_TEXT)
 
 # --- Comando /help ---
+HELP_TEXT = (
+    "🆘 <b>Ayuda - Comandos disponibles:</b>\n\n"
+    "🔹 <b>/start</b> - Muestra el mensaje de bienvenida\n"
+    "🔹 <b>/help</b> - Muestra esta ayuda\n"
+    "🔹 <b>/ofertas</b> - Muestra productos por rango de descuento\n"
+    "🔹 <b>/buscar [término]</b> - Busca productos por palabra clave\n"
+    "🔹 <b>/categoria</b> - Muestra productos por categoría\n"
+    "🔹 <b>/objetivo</b> - Muestra productos por objetivo\n\n"
+    "No dudes en preguntar si tienes alguna duda o necesitas ayuda adicional. "
+    "¡Estamos aquí para ayudarte y para realizar pedidos al 608.195.146! 😊\n\n"
+    "Si quieres estar al día de todas las ofertas y novedades, únete a nuestro canal de Telegram: "
+    "<a href='https://t.me/Supleshop_Ofertas'>@Supleshop_Ofertas</a>\n\n"
+    "Si quieres ver los productos de Supleshop, puedes hacerlo en su web: "
+    "<a href='https://www.supleshop.es'>www.supleshop.es</a>"
+)
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = (
-        "🆘 <b>Ayuda - Comandos disponibles:</b>\n\n"
-        "🔹 <b>/start</b> - Muestra el mensaje de bienvenida\n"
-        "🔹 <b>/help</b> - Muestra esta ayuda\n"
-        "🔹 <b>/ofertas</b> - Muestra productos por rango de descuento\n"
-        "🔹 <b>/buscar [término]</b> - Busca productos por palabra clave\n"
-        "🔹 <b>/categoria</b> - Muestra productos por categoría\n"
-        "🔹 <b>/objetivo</b> - Muestra productos por objetivo\n\n"
-        "No dudes en preguntar si tienes alguna duda o necesitas ayuda adicional. "
-        "¡Estamos aquí para ayudarte y para realizar pedidos al 608.195.146! 😊\n\n"
-        "Si quieres estar al día de todas las ofertas y novedades, únete a nuestro canal de Telegram: "
-        "<a href='https://t.me/Supleshop_Ofertas'>@Supleshop_Ofertas</a>\n\n"
-        "Si quieres ver los productos de Supleshop, puedes hacerlo en su web: "
-        "<a href='https://www.supleshop.es'>www.supleshop.es</a>"
-    )
-    
     # Alternativamente, puedes dividir el mensaje en dos partes si es muy largo
     try:
-        await update.message.reply_text(help_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+        await update.message.reply_text(HELP_TEXT, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
     except Exception as e:
         logger.error(f"Error al enviar mensaje de ayuda: {e}")
         # Enviar versión simplificada si falla
@@ -745,12 +995,28 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Función principal ---
 def main():
-    bot_token = config.get("TELEGRAM_BOT_TOKEN")
+    bot_token = CFG.bot_token
     if not bot_token:
         logger.error("No se encontró el token del bot en la configuración.")
         return
         
-    application = Application.builder().token(bot_token).build()
+    # getUpdates usa su propio pool para que el long polling no ocupe conexiones de envío
+    application = (
+        Application.builder()
+        .token(bot_token)
+        .request(HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            pool_timeout=TELEGRAM_POOL_TIMEOUT,
+            connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+            read_timeout=TELEGRAM_READ_TIMEOUT,
+            write_timeout=TELEGRAM_WRITE_TIMEOUT,
+        ))
+        .get_updates_request(HTTPXRequest(
+            connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+            read_timeout=TELEGRAM_READ_TIMEOUT,
+        ))
+        .build()
+    )
     
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -761,16 +1027,18 @@ def main():
     
     application.add_handler(CommandHandler("force_update", force_update))
     
-    application.add_handler(CallbackQueryHandler(handle_discount_selection, pattern="^discount_"))
-    application.add_handler(CallbackQueryHandler(handle_categoria_selection, pattern="^cat_"))
-    application.add_handler(CallbackQueryHandler(handle_objetivo_selection, pattern="^obj_"))
+    application.add_handler(CallbackQueryHandler(handle_callback_query))
     
-    job_interval = config.get("UPDATE_INTERVAL_MINUTES", 10)
+    job_interval = CFG.update_interval
     application.job_queue.run_repeating(process_sheet_data, interval=job_interval*60, first=10)
     
     logger.info("Bot iniciado exitosamente.")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+    # Guardar cualquier cambio pendiente antes de salir
+    for path, dump in _pending_writes.items():
+        _write_file(path, dump())
+
 # --- Iniciar aplicación ---
 if __name__ == "__main__":
     try: